@@ -4,16 +4,16 @@ import time
 
 import httpx
 import jwt
-from sqlalchemy.orm import Session
 
 from . import crud
+from .db import ShardSessions
 
 
 logger = logging.getLogger("seguridad.apns")
 
 
-def send_alert_push(db: Session, owner_device_id: str, alert_type: str) -> None:
-    tokens = crud.get_subscriber_tokens(db, owner_device_id)
+def send_alert_push(shards: ShardSessions, owner_device_id: str, alert_type: str) -> None:
+    tokens = crud.get_subscriber_tokens(shards, owner_device_id)
     if not tokens:
         return
 
@@ -47,6 +47,18 @@ def send_alert_push(db: Session, owner_device_id: str, alert_type: str) -> None:
                 logger.warning(
                     "APNs error %s: %s", response.status_code, response.text
                 )
+                if _token_is_stale(response):
+                    crud.delete_device_token(token)
+
+
+def _token_is_stale(response: httpx.Response) -> bool:
+    if response.status_code == 410:
+        return True
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and body.get("reason") == "Unregistered"
 
 
 def _create_jwt(team_id: str, key_id: str, auth_key: str) -> str:
@@ -0,0 +1,182 @@
+import json
+import math
+import os
+import struct
+import zlib
+from datetime import datetime, timezone
+
+import msgpack
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+from . import schemas
+
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+PACKED_CONTENT_TYPE = "application/x-location-packed"
+
+MAX_BODY_BYTES = int(os.getenv("LOCATION_MAX_BODY_BYTES", str(1024 * 1024)))
+
+# Packed format: little-endian uint16 device id length, UTF-8 device id, then
+# fixed-width points of float64 latitude, float64 longitude, float32 accuracy
+# and float64 Unix timestamp in seconds.
+_PACKED_HEADER = struct.Struct("<H")
+_PACKED_POINT = struct.Struct("<ddfd")
+
+
+async def location_update(request: Request) -> schemas.LocationUpdateRequest:
+    """Single location upload in JSON, MessagePack or packed binary."""
+    content_type, body = await _read_body(request)
+    if content_type == PACKED_CONTENT_TYPE:
+        batch = _decode_packed(body)
+        if len(batch.points) != 1:
+            raise HTTPException(status_code=400, detail="Expected exactly one location")
+        point = batch.points[0]
+        return schemas.LocationUpdateRequest.model_construct(
+            device_id=batch.device_id,
+            latitude=point.latitude,
+            longitude=point.longitude,
+            accuracy=point.accuracy,
+            timestamp=point.timestamp,
+        )
+
+    data = _decode_document(content_type, body)
+    try:
+        return schemas.LocationUpdateRequest.model_validate(data)
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors()) from exc
+
+
+async def location_batch(request: Request) -> schemas.LocationBatch:
+    """Batch upload for one device, decoded without building a model per point.
+
+    JSON and MessagePack bodies are ``{"deviceId": ..., "points": [[latitude,
+    longitude, accuracy, timestamp], ...]}`` where timestamp is Unix seconds or
+    an ISO 8601 string.
+    """
+    content_type, body = await _read_body(request)
+    if content_type == PACKED_CONTENT_TYPE:
+        return _decode_packed(body)
+
+    data = _decode_document(content_type, body)
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Malformed location batch")
+    device_id = data.get("deviceId", data.get("device_id"))
+    rows = data.get("points")
+    if not isinstance(device_id, str) or not device_id or not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Malformed location batch")
+
+    points = []
+    for row in rows:
+        if not isinstance(row, (list, tuple)) or len(row) != 4:
+            raise HTTPException(status_code=400, detail="Malformed location point")
+        points.append(_point(row[0], row[1], row[2], _timestamp(row[3])))
+    return schemas.LocationBatch(device_id, points)
+
+
+async def _read_body(request: Request) -> tuple[str, bytes]:
+    content_type = request.headers.get("content-type", JSON_CONTENT_TYPE).split(";")[0].strip().lower()
+    encoding = request.headers.get("content-encoding", "identity").strip().lower()
+
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            declared = int(content_length)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid Content-Length")
+        if declared > MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Body too large")
+
+    buffer = bytearray()
+    async for chunk in request.stream():
+        buffer.extend(chunk)
+        if len(buffer) > MAX_BODY_BYTES:
+            raise HTTPException(status_code=413, detail="Body too large")
+    body = bytes(buffer)
+
+    try:
+        if encoding in ("gzip", "x-gzip"):
+            body = _inflate(body, zlib.MAX_WBITS | 16)
+        elif encoding == "deflate":
+            try:
+                body = _inflate(body, zlib.MAX_WBITS)
+            except zlib.error:
+                body = _inflate(body, -zlib.MAX_WBITS)
+        elif encoding != "identity":
+            raise HTTPException(status_code=415, detail="Unsupported content encoding")
+    except zlib.error:
+        raise HTTPException(status_code=400, detail="Malformed compressed body")
+    return content_type, body
+
+
+def _inflate(body: bytes, wbits: int) -> bytes:
+    decompressor = zlib.decompressobj(wbits)
+    data = decompressor.decompress(body, MAX_BODY_BYTES + 1)
+    if len(data) > MAX_BODY_BYTES or decompressor.unconsumed_tail:
+        raise HTTPException(status_code=413, detail="Body too large")
+    return data
+
+
+def _decode_document(content_type: str, body: bytes):
+    try:
+        if content_type in MSGPACK_CONTENT_TYPES:
+            return msgpack.unpackb(body, timestamp=3)
+        if content_type == JSON_CONTENT_TYPE or content_type.endswith("+json"):
+            return json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Malformed body")
+    raise HTTPException(status_code=415, detail="Unsupported content type")
+
+
+def _decode_packed(body: bytes) -> schemas.LocationBatch:
+    if len(body) < _PACKED_HEADER.size:
+        raise HTTPException(status_code=400, detail="Malformed location batch")
+    (id_length,) = _PACKED_HEADER.unpack_from(body)
+    offset = _PACKED_HEADER.size + id_length
+    if offset > len(body) or (len(body) - offset) % _PACKED_POINT.size:
+        raise HTTPException(status_code=400, detail="Malformed location batch")
+    try:
+        device_id = body[_PACKED_HEADER.size:offset].decode("utf-8")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Malformed location batch")
+    if not device_id:
+        raise HTTPException(status_code=400, detail="Malformed location batch")
+
+    points = [
+        _point(latitude, longitude, accuracy, _timestamp(timestamp))
+        for latitude, longitude, accuracy, timestamp in _PACKED_POINT.iter_unpack(body[offset:])
+    ]
+    return schemas.LocationBatch(device_id, points)
+
+
+def _point(latitude, longitude, accuracy, timestamp: datetime) -> schemas.LocationPoint:
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+        accuracy = float(accuracy)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Malformed location point")
+    if not (-90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0):
+        raise HTTPException(status_code=400, detail="Location out of range")
+    if not math.isfinite(accuracy) or accuracy < 0:
+        raise HTTPException(status_code=400, detail="Invalid accuracy")
+    return schemas.LocationPoint(latitude, longitude, accuracy, timestamp)
+
+
+def _timestamp(value) -> datetime:
+    try:
+        if isinstance(value, datetime):
+            timestamp = value
+        elif isinstance(value, str):
+            timestamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+            return datetime.fromtimestamp(value, tz=timezone.utc)
+        else:
+            raise ValueError(value)
+    except (ValueError, OverflowError, OSError):
+        raise HTTPException(status_code=400, detail="Invalid timestamp")
+    if timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=timezone.utc)
+    return timestamp
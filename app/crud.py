@@ -1,8 +1,15 @@
 from datetime import datetime, timedelta
 import secrets
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, object_session
 
-from . import models, schemas
+from . import geoindex, models, schemas
+from .db import ShardSessions, router
+
+
+_CODE_ATTEMPTS = 10
 
 
 def get_device_by_device_id(db: Session, device_id: str) -> models.Device | None:
@@ -29,7 +36,8 @@ def get_or_create_device(db: Session, device_id: str, platform: str) -> models.D
     return device
 
 
-def upsert_safezone(db: Session, payload: schemas.SafeZoneRequest) -> models.SafeZone:
+def upsert_safezone(shards: ShardSessions, payload: schemas.SafeZoneRequest) -> models.SafeZone:
+    db = shards.for_device(payload.device_id)
     device = get_or_create_device(db, payload.device_id, "ios")
     zone = (
         db.query(models.SafeZone)
@@ -51,7 +59,8 @@ def upsert_safezone(db: Session, payload: schemas.SafeZoneRequest) -> models.Saf
     return zone
 
 
-def create_location(db: Session, payload: schemas.LocationUpdateRequest) -> models.LocationEvent:
+def create_location(shards: ShardSessions, payload: schemas.LocationUpdateRequest) -> models.LocationEvent:
+    db = shards.for_device(payload.device_id)
     device = get_or_create_device(db, payload.device_id, "ios")
     event = models.LocationEvent(
         device_id=device.id,
@@ -63,10 +72,48 @@ def create_location(db: Session, payload: schemas.LocationUpdateRequest) -> mode
     db.add(event)
     db.commit()
     db.refresh(event)
+    geoindex.index.update(
+        device.device_id,
+        event.latitude,
+        event.longitude,
+        event.accuracy,
+        event.timestamp,
+    )
     return event
 
 
-def create_alert(db: Session, payload: schemas.AlertEventRequest) -> models.AlertEvent:
+def create_locations(shards: ShardSessions, batch: schemas.LocationBatch) -> int:
+    if not batch.points:
+        return 0
+    db = shards.for_device(batch.device_id)
+    device = get_or_create_device(db, batch.device_id, "ios")
+    db.execute(
+        insert(models.LocationEvent),
+        [
+            {
+                "device_id": device.id,
+                "latitude": point.latitude,
+                "longitude": point.longitude,
+                "accuracy": point.accuracy,
+                "timestamp": point.timestamp,
+            }
+            for point in batch.points
+        ],
+    )
+    db.commit()
+    newest = max(batch.points, key=lambda point: point.timestamp)
+    geoindex.index.update(
+        device.device_id,
+        newest.latitude,
+        newest.longitude,
+        newest.accuracy,
+        newest.timestamp,
+    )
+    return len(batch.points)
+
+
+def create_alert(shards: ShardSessions, payload: schemas.AlertEventRequest) -> models.AlertEvent:
+    db = shards.for_device(payload.device_id)
     device = get_or_create_device(db, payload.device_id, "ios")
     alert = models.AlertEvent(
         device_id=device.id,
@@ -81,7 +128,8 @@ def create_alert(db: Session, payload: schemas.AlertEventRequest) -> models.Aler
     return alert
 
 
-def upsert_contact(db: Session, payload: schemas.ContactRequest) -> models.Contact:
+def upsert_contact(shards: ShardSessions, payload: schemas.ContactRequest) -> models.Contact:
+    db = shards.for_device(payload.device_id)
     device = get_or_create_device(db, payload.device_id, "ios")
     contact = (
         db.query(models.Contact)
@@ -99,7 +147,18 @@ def upsert_contact(db: Session, payload: schemas.ContactRequest) -> models.Conta
     return contact
 
 
-def upsert_device_token(db: Session, payload: schemas.DeviceTokenRequest) -> models.DeviceToken:
+def upsert_device_token(shards: ShardSessions, payload: schemas.DeviceTokenRequest) -> models.DeviceToken:
+    home = router.shard_for(payload.device_id)
+    # A token moves with the phone, not the device id; drop any copy left on
+    # another shard so pushes only reach its current device.
+    for index in range(router.shard_count):
+        if index == home:
+            continue
+        other = shards.shard(index)
+        other.execute(delete(models.DeviceToken).where(models.DeviceToken.token == payload.token))
+        other.commit()
+
+    db = shards.shard(home)
     device = get_or_create_device(db, payload.device_id, "ios")
     token = db.query(models.DeviceToken).filter(models.DeviceToken.token == payload.token).first()
     if token is None:
@@ -119,43 +178,53 @@ def upsert_device_token(db: Session, payload: schemas.DeviceTokenRequest) -> mod
     return token
 
 
-def create_subscription(db: Session, payload: schemas.SubscriptionRequest) -> models.Subscription:
-    owner = get_or_create_device(db, payload.owner_device_id, "ios")
-    subscriber = get_or_create_device(db, payload.subscriber_device_id, "ios")
-    existing = (
-        db.query(models.Subscription)
-        .filter(
-            models.Subscription.owner_device_id == owner.id,
-            models.Subscription.subscriber_device_id == subscriber.id,
-        )
-        .first()
-    )
-    if existing:
-        return existing
-
-    subscription = models.Subscription(
-        owner_device_id=owner.id,
-        subscriber_device_id=subscriber.id,
-    )
-    db.add(subscription)
-    db.commit()
-    db.refresh(subscription)
-    return subscription
+def create_subscription(shards: ShardSessions, payload: schemas.SubscriptionRequest) -> models.Subscription:
+    subscriptions = [
+        _link_devices(db, payload.owner_device_id, payload.subscriber_device_id)
+        for db in _subscription_shards(shards, payload.owner_device_id, payload.subscriber_device_id)
+    ]
+    return subscriptions[-1]
 
 
-def get_subscriber_tokens(db: Session, owner_device_id: str) -> list[models.DeviceToken]:
+def get_subscriber_tokens(shards: ShardSessions, owner_device_id: str) -> list[models.DeviceToken]:
+    db = shards.for_device(owner_device_id)
     owner = get_device_by_device_id(db, owner_device_id)
     if owner is None:
         return []
-    return (
-        db.query(models.DeviceToken)
-        .join(models.Subscription, models.Subscription.subscriber_device_id == models.DeviceToken.device_id)
+    rows = (
+        db.query(models.Device.device_id)
+        .join(models.Subscription, models.Subscription.subscriber_device_id == models.Device.id)
         .filter(models.Subscription.owner_device_id == owner.id)
         .all()
     )
+    # A token that moved to a device on another shard can still be stored on
+    # the old one; keep the most recently seen copy.
+    tokens: dict[str, models.DeviceToken] = {}
+    for index, device_ids in router.partition(row.device_id for row in rows).items():
+        shard_tokens = (
+            shards.shard(index)
+            .query(models.DeviceToken)
+            .join(models.Device, models.Device.id == models.DeviceToken.device_id)
+            .filter(models.Device.device_id.in_(device_ids))
+            .all()
+        )
+        for token in shard_tokens:
+            current = tokens.get(token.token)
+            if current is None or _last_seen(token) > _last_seen(current):
+                tokens[token.token] = token
+    return list(tokens.values())
+
+
+def delete_device_token(token: models.DeviceToken) -> None:
+    db = object_session(token)
+    if db is None:
+        return
+    db.delete(token)
+    db.commit()
 
 
-def get_invitation_by_owner(db: Session, owner_device_id: str) -> models.Invitation | None:
+def get_invitation_by_owner(shards: ShardSessions, owner_device_id: str) -> models.Invitation | None:
+    db = shards.for_device(owner_device_id)
     owner = get_device_by_device_id(db, owner_device_id)
     if owner is None:
         return None
@@ -167,85 +236,135 @@ def get_invitation_by_owner(db: Session, owner_device_id: str) -> models.Invitat
 
 
 def create_or_rotate_invitation(
-    db: Session,
+    shards: ShardSessions,
     payload: schemas.InvitationRequest,
     ttl_days: int = 7,
 ) -> models.Invitation:
+    shard = router.shard_for(payload.owner_device_id)
+    db = shards.shard(shard)
     owner = get_or_create_device(db, payload.owner_device_id, "ios")
-    existing = (
-        db.query(models.Invitation)
-        .filter(models.Invitation.owner_device_id == owner.id)
-        .first()
-    )
+    owner_id = owner.id
     expires_at = datetime.utcnow() + timedelta(days=ttl_days)
-    code = _generate_unique_code(db)
-
-    if existing:
-        existing.code = code
-        existing.expires_at = expires_at
-        db.commit()
-        db.refresh(existing)
-        return existing
-
-    invitation = models.Invitation(
-        owner_device_id=owner.id,
-        code=code,
-        expires_at=expires_at,
-    )
-    db.add(invitation)
-    db.commit()
-    db.refresh(invitation)
-    return invitation
+    upsert = _upsert_for(db)
+
+    # Upsert on the owner and let the unique code constraint reject the rare
+    # collision, so allocation is one statement instead of probe-then-write.
+    for attempt in range(_CODE_ATTEMPTS):
+        stmt = upsert(models.Invitation).values(
+            owner_device_id=owner_id,
+            code=_random_code(shard),
+            expires_at=expires_at,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.Invitation.owner_device_id],
+            set_={"code": stmt.excluded.code, "expires_at": stmt.excluded.expires_at},
+        ).returning(models.Invitation)
+        try:
+            invitation = db.scalars(stmt, execution_options={"populate_existing": True}).one()
+            db.commit()
+            return invitation
+        except IntegrityError:
+            db.rollback()
+            if attempt == _CODE_ATTEMPTS - 1:
+                raise
 
 
 def confirm_subscription_with_code(
-    db: Session,
+    shards: ShardSessions,
     payload: schemas.SubscriptionConfirmRequest,
 ) -> str | None:
+    if not (payload.code.isascii() and payload.code.isdecimal()):
+        return None
+    db = shards.shard(int(payload.code) % router.shard_count)
     invitation = (
-        db.query(models.Invitation)
-        .filter(models.Invitation.code == payload.code)
+        db.query(models.Invitation.owner_device_id, models.Device.device_id)
+        .join(models.Device, models.Device.id == models.Invitation.owner_device_id)
+        .filter(models.Invitation.code == payload.code, models.Invitation.expires_at >= func.now())
         .first()
     )
     if invitation is None:
         return None
-    if invitation.expires_at < datetime.utcnow():
-        return None
 
-    subscriber = get_or_create_device(db, payload.subscriber_device_id, "ios")
+    for db in _subscription_shards(shards, invitation.device_id, payload.subscriber_device_id):
+        _link_devices(db, invitation.device_id, payload.subscriber_device_id)
+    return invitation.device_id
+
+
+def delete_expired_invitations(db: Session, batch_size: int) -> int:
+    expired = (
+        select(models.Invitation.id)
+        .where(models.Invitation.expires_at < func.now())
+        .limit(batch_size)
+    )
+    result = db.execute(
+        delete(models.Invitation)
+        .where(models.Invitation.id.in_(expired))
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount
+
+
+def _random_code(shard: int, length: int = 6) -> str:
+    # Codes are congruent to the owner's shard modulo the shard count, so
+    # confirmation can go straight to the shard holding the invitation. This
+    # relies on the shard count never changing while codes are live.
+    space = 10**length // router.shard_count
+    return str(secrets.randbelow(space) * router.shard_count + shard).zfill(length)
+
+
+def _last_seen(token: models.DeviceToken) -> datetime:
+    return (token.last_seen_at or datetime.min).replace(tzinfo=None)
+
+
+def _subscription_shards(shards: ShardSessions, owner_device_id: str, subscriber_device_id: str) -> list[Session]:
+    """Subscriptions are stored on the owner's and the subscriber's shard, so
+    both "who follows me" and "whom do I follow" stay single-shard reads.
+
+    The two writes commit separately. The subscriber's shard comes first, and
+    a failure on either propagates so the endpoint errors and the client
+    retries; the link is idempotent, so a retry completes the missing side.
+    """
+    indexes = dict.fromkeys(
+        (router.shard_for(subscriber_device_id), router.shard_for(owner_device_id))
+    )
+    return [shards.shard(index) for index in indexes]
+
+
+def _link_devices(db: Session, owner_device_id: str, subscriber_device_id: str) -> models.Subscription:
+    # The device living on another shard gets a bare row here to satisfy
+    # the foreign keys; its data stays on its own shard.
+    owner = get_or_create_device(db, owner_device_id, "ios")
+    subscriber = get_or_create_device(db, subscriber_device_id, "ios")
     existing = (
         db.query(models.Subscription)
         .filter(
-            models.Subscription.owner_device_id == invitation.owner_device_id,
+            models.Subscription.owner_device_id == owner.id,
             models.Subscription.subscriber_device_id == subscriber.id,
         )
         .first()
     )
     if existing:
-        owner = get_device_by_id(db, invitation.owner_device_id)
-        return owner.device_id if owner else None
+        return existing
 
     subscription = models.Subscription(
-        owner_device_id=invitation.owner_device_id,
+        owner_device_id=owner.id,
         subscriber_device_id=subscriber.id,
     )
     db.add(subscription)
     db.commit()
     db.refresh(subscription)
-    owner = get_device_by_id(db, invitation.owner_device_id)
-    return owner.device_id if owner else None
+    return subscription
 
 
-def _generate_unique_code(db: Session, length: int = 6) -> str:
-    for _ in range(10):
-        code = "".join(secrets.choice("0123456789") for _ in range(length))
-        exists = db.query(models.Invitation).filter(models.Invitation.code == code).first()
-        if not exists:
-            return code
-    return secrets.token_hex(3)
+def _upsert_for(db: Session):
+    if db.get_bind().dialect.name == "sqlite":
+        return sqlite.insert
+    return postgresql.insert
 
 
-def get_latest_location(db: Session, device_id: str) -> models.LocationEvent | None:
+def get_latest_location(shards: ShardSessions, device_id: str) -> models.LocationEvent | None:
+    db = shards.for_device(device_id)
     device = get_device_by_device_id(db, device_id)
     if device is None:
         return None
@@ -257,7 +376,8 @@ def get_latest_location(db: Session, device_id: str) -> models.LocationEvent | N
     )
 
 
-def get_location_history(db: Session, device_id: str, limit: int) -> list[models.LocationEvent]:
+def get_location_history(shards: ShardSessions, device_id: str, limit: int) -> list[models.LocationEvent]:
+    db = shards.for_device(device_id)
     device = get_device_by_device_id(db, device_id)
     if device is None:
         return []
@@ -268,3 +388,130 @@ def get_location_history(db: Session, device_id: str, limit: int) -> list[models
         .limit(limit)
         .all()
     )
+
+
+def get_followed_device_ids(shards: ShardSessions, subscriber_device_id: str) -> set[str]:
+    db = shards.for_device(subscriber_device_id)
+    subscriber = get_device_by_device_id(db, subscriber_device_id)
+    if subscriber is None:
+        return set()
+    rows = (
+        db.query(models.Device.device_id)
+        .join(models.Subscription, models.Subscription.owner_device_id == models.Device.id)
+        .filter(models.Subscription.subscriber_device_id == subscriber.id)
+        .all()
+    )
+    return {row.device_id for row in rows}
+
+
+def load_latest_positions(shards: ShardSessions, device_ids: set[str]) -> None:
+    """Seed the geo index with the newest stored location of each device it
+    has not seen yet, in a single query per shard."""
+    missing = geoindex.index.missing(device_ids)
+    for index, shard_device_ids in router.partition(missing).items():
+        _load_latest_positions(shards.shard(index), shard_device_ids)
+    geoindex.index.mark_absent(missing)
+
+
+def _load_latest_positions(db: Session, missing: list[str]) -> None:
+    latest = (
+        db.query(
+            models.LocationEvent.device_id.label("device_pk"),
+            func.max(models.LocationEvent.timestamp).label("timestamp"),
+        )
+        .join(models.Device, models.Device.id == models.LocationEvent.device_id)
+        .filter(models.Device.device_id.in_(missing))
+        .group_by(models.LocationEvent.device_id)
+        .subquery()
+    )
+    rows = (
+        db.query(models.Device.device_id, models.LocationEvent)
+        .join(models.LocationEvent, models.LocationEvent.device_id == models.Device.id)
+        .join(
+            latest,
+            (latest.c.device_pk == models.LocationEvent.device_id)
+            & (latest.c.timestamp == models.LocationEvent.timestamp),
+        )
+        .all()
+    )
+    for device_id, event in rows:
+        geoindex.index.update(
+            device_id,
+            event.latitude,
+            event.longitude,
+            event.accuracy,
+            event.timestamp,
+        )
+
+
+def get_nearby_followed(
+    shards: ShardSessions,
+    subscriber_device_id: str,
+    radius_meters: float,
+    latitude: float | None = None,
+    longitude: float | None = None,
+) -> list[tuple[geoindex.IndexedPosition, float]] | None:
+    followed = get_followed_device_ids(shards, subscriber_device_id)
+    if latitude is None or longitude is None:
+        load_latest_positions(shards, followed | {subscriber_device_id})
+        center = geoindex.index.get(subscriber_device_id)
+        if center is None:
+            return None
+        latitude, longitude = center.latitude, center.longitude
+    else:
+        load_latest_positions(shards, followed)
+    if not followed:
+        return []
+    return geoindex.index.within(latitude, longitude, radius_meters, followed)
+
+
+def create_erasure_job(shards: ShardSessions, device_id: str) -> models.ErasureJob | None:
+    db = shards.for_device(device_id)
+    existing = get_erasure_job(shards, device_id)
+    if existing is not None and existing.status in ("pending", "running"):
+        return existing
+    if existing is not None and existing.status == "failed":
+        # Retry in place: the home device row may already be gone, and the
+        # job resumes from the stage it failed in.
+        existing.status = "pending"
+        existing.error = None
+        existing.finished_at = None
+        db.commit()
+        db.refresh(existing)
+        return existing
+    if get_device_by_device_id(db, device_id) is None:
+        return existing
+
+    job = models.ErasureJob(device_id=device_id, status="pending")
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def get_erasure_job(shards: ShardSessions, device_id: str) -> models.ErasureJob | None:
+    db = shards.for_device(device_id)
+    return (
+        db.query(models.ErasureJob)
+        .filter(models.ErasureJob.device_id == device_id)
+        .order_by(models.ErasureJob.id.desc())
+        .first()
+    )
+
+
+def get_unfinished_erasure_jobs(db: Session) -> list[models.ErasureJob]:
+    return (
+        db.query(models.ErasureJob)
+        .filter(models.ErasureJob.status.in_(("pending", "running")))
+        .order_by(models.ErasureJob.id)
+        .all()
+    )
+
+
+def delete_rows_batch(db: Session, column, device_pk: int, batch_size: int) -> int:
+    """Delete up to ``batch_size`` rows whose ``column`` points at the device,
+    without loading them into the session. The caller commits."""
+    table = column.table
+    batch = select(table.c.id).where(column == device_pk).limit(batch_size)
+    result = db.execute(delete(table).where(table.c.id.in_(batch)))
+    return result.rowcount
@@ -0,0 +1,142 @@
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+
+from sqlalchemy import delete
+
+from . import crud, geoindex, models
+from .db import router, session_factories
+
+
+logger = logging.getLogger("seguridad.erasure")
+
+ERASURE_BATCH_SIZE = int(os.getenv("ERASURE_BATCH_SIZE", "5000"))
+if ERASURE_BATCH_SIZE <= 0:
+    raise ValueError("ERASURE_BATCH_SIZE must be positive")
+
+# Child rows purged batch by batch before the device row itself goes; what
+# is left by then is removed by the database's ON DELETE CASCADE.
+_PURGE_COLUMNS = (
+    models.LocationEvent.__table__.c.device_id,
+    models.AlertEvent.__table__.c.device_id,
+    models.SafeZone.__table__.c.device_id,
+    models.Contact.__table__.c.device_id,
+    models.DeviceToken.__table__.c.device_id,
+    models.Invitation.__table__.c.owner_device_id,
+    models.Subscription.__table__.c.owner_device_id,
+    models.Subscription.__table__.c.subscriber_device_id,
+)
+
+_PURGE_STAGES = [f"{column.table.name}.{column.name}" for column in _PURGE_COLUMNS]
+
+_jobs: queue.Queue = queue.Queue()
+_stop = threading.Event()
+_thread: threading.Thread | None = None
+
+
+def enqueue(device_id: str, job_id: int) -> None:
+    _jobs.put((router.shard_for(device_id), job_id))
+
+
+def run_job(shard: int, job_id: int, batch_size: int = ERASURE_BATCH_SIZE) -> None:
+    db = session_factories[shard]()
+    try:
+        job = db.get(models.ErasureJob, job_id)
+        if job is None or job.status == "done":
+            return
+        job.status = "running"
+        db.commit()
+
+        try:
+            device = crud.get_device_by_device_id(db, job.device_id)
+            if device is not None:
+                device_pk = device.id
+                # A retried job skips the stages it already finished.
+                start = _PURGE_STAGES.index(job.stage) if job.stage in _PURGE_STAGES else 0
+                for column, stage in zip(_PURGE_COLUMNS[start:], _PURGE_STAGES[start:]):
+                    job.stage = stage
+                    while not _stop.is_set():
+                        deleted = crud.delete_rows_batch(db, column, device_pk, batch_size)
+                        job.deleted_rows += deleted
+                        db.commit()
+                        if deleted < batch_size:
+                            break
+                    if _stop.is_set():
+                        return
+
+                job.stage = "devices"
+                db.execute(delete(models.Device).where(models.Device.id == device_pk))
+                db.commit()
+
+            job.stage = "remote devices"
+            db.commit()
+            _remove_remote_rows(shard, job.device_id)
+            geoindex.index.remove(job.device_id)
+            job.status = "done"
+            job.stage = None
+            job.finished_at = datetime.utcnow()
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            job.status = "failed"
+            job.error = str(exc)
+            job.finished_at = datetime.utcnow()
+            db.commit()
+            raise
+    finally:
+        db.close()
+
+
+def resume_unfinished() -> None:
+    """Requeue jobs interrupted by a restart."""
+    for shard, session_factory in enumerate(session_factories):
+        db = session_factory()
+        try:
+            for job in crud.get_unfinished_erasure_jobs(db):
+                _jobs.put((shard, job.id))
+        finally:
+            db.close()
+
+
+def start() -> None:
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="device-erasure", daemon=True)
+    _thread.start()
+
+
+def stop() -> None:
+    _stop.set()
+    _jobs.put(None)
+    if _thread is not None:
+        _thread.join(timeout=5)
+
+
+def _remove_remote_rows(home: int, device_id: str) -> None:
+    # Other shards only hold the bare device row created for mirrored
+    # subscriptions; deleting it cascades to those subscriptions.
+    for shard, session_factory in enumerate(session_factories):
+        if shard == home:
+            continue
+        db = session_factory()
+        try:
+            db.execute(delete(models.Device).where(models.Device.device_id == device_id))
+            db.commit()
+        finally:
+            db.close()
+
+
+def _run() -> None:
+    while not _stop.is_set():
+        item = _jobs.get()
+        if item is None:
+            return
+        shard, job_id = item
+        try:
+            run_job(shard, job_id)
+        except Exception as exc:
+            logger.warning("Device erasure job %s failed: %s", job_id, exc)
@@ -0,0 +1,248 @@
+import math
+import os
+import threading
+import time
+from collections.abc import Iterable
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+_EARTH_RADIUS_METERS = 6_371_008.8
+_METERS_PER_DEGREE_LAT = 111_320.0
+_MAX_QUERY_CELLS = 16
+_ABSENT_TTL_SECONDS = float(os.getenv("GEOINDEX_ABSENT_TTL_SECONDS", "60"))
+
+
+class IndexedPosition(NamedTuple):
+    device_id: str
+    latitude: float
+    longitude: float
+    accuracy: float
+    timestamp: datetime
+    geohash: str
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int) -> str:
+    lat_lo, lat_hi = -90.0, 90.0
+    lon_lo, lon_hi = -180.0, 180.0
+    longitude = ((longitude + 180.0) % 360.0) - 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_lo + lon_hi) / 2
+            if longitude >= mid:
+                value = (value << 1) | 1
+                lon_lo = mid
+            else:
+                value <<= 1
+                lon_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if latitude >= mid:
+                value = (value << 1) | 1
+                lat_lo = mid
+            else:
+                value <<= 1
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def haversine_meters(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * _EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _cell_size_degrees(precision: int) -> tuple[float, float]:
+    total_bits = 5 * precision
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / (1 << lat_bits), 360.0 / (1 << lon_bits)
+
+
+def _covering_cells(latitude: float, longitude: float, radius_meters: float, precision: int) -> list[str] | None:
+    """Geohash cells at ``precision`` covering the circle's bounding box, or
+    None when that would take more than ``_MAX_QUERY_CELLS`` cells."""
+    lat_delta = radius_meters / _METERS_PER_DEGREE_LAT
+    south = max(-90.0, latitude - lat_delta)
+    north = min(90.0, latitude + lat_delta)
+    cos_lat = min(math.cos(math.radians(south)), math.cos(math.radians(north)))
+    if cos_lat <= 1e-9:
+        lon_delta = 180.0
+    else:
+        lon_delta = min(180.0, radius_meters / (_METERS_PER_DEGREE_LAT * cos_lat))
+
+    cell_lat, cell_lon = _cell_size_degrees(precision)
+    lat_start = math.floor((south + 90.0) / cell_lat)
+    lat_end = math.floor((north + 90.0) / cell_lat)
+    if lon_delta >= 180.0:
+        lon_start, lon_end = 0, (1 << ((5 * precision + 1) // 2)) - 1
+    else:
+        lon_start = math.floor((longitude - lon_delta + 180.0) / cell_lon)
+        lon_end = math.floor((longitude + lon_delta + 180.0) / cell_lon)
+
+    lat_steps = lat_end - lat_start + 1
+    lon_steps = min(lon_end - lon_start + 1, 1 << ((5 * precision + 1) // 2))
+    if lat_steps * lon_steps > _MAX_QUERY_CELLS:
+        return None
+
+    cells = set()
+    for i in range(lat_start, lat_end + 1):
+        cell_center_lat = min(90.0, -90.0 + (i + 0.5) * cell_lat)
+        for j in range(lon_start, lon_start + lon_steps):
+            cell_center_lon = -180.0 + (j + 0.5) * cell_lon
+            cells.add(encode_geohash(cell_center_lat, cell_center_lon, precision))
+    return list(cells)
+
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+class GeoIndex:
+    """In-memory last-known position per device, bucketed by geohash prefix.
+
+    Every prefix of a device's geohash (1..precision characters) owns a bucket,
+    so a radius query can pick whichever cell size keeps the lookup to a
+    handful of neighbouring cells. The index is per process; callers are
+    expected to fall back to the database for devices it has not seen yet,
+    and to report devices with no stored location through ``mark_absent`` so
+    they are not looked up again until the entry expires.
+    """
+
+    def __init__(self, precision: int = 7, absent_ttl_seconds: float = _ABSENT_TTL_SECONDS):
+        self.precision = precision
+        self.absent_ttl_seconds = absent_ttl_seconds
+        self._positions: dict[str, IndexedPosition] = {}
+        self._cells: dict[str, set[str]] = {}
+        self._absent: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def update(
+        self,
+        device_id: str,
+        latitude: float,
+        longitude: float,
+        accuracy: float,
+        timestamp: datetime,
+    ) -> None:
+        geohash = encode_geohash(latitude, longitude, self.precision)
+        position = IndexedPosition(device_id, latitude, longitude, accuracy, timestamp, geohash)
+        with self._lock:
+            previous = self._positions.get(device_id)
+            if previous is not None:
+                if _as_utc(previous.timestamp) > _as_utc(timestamp):
+                    return
+                self._unbucket(device_id, previous.geohash, geohash)
+                self._bucket(device_id, geohash, previous.geohash)
+            else:
+                self._bucket(device_id, geohash, "")
+            self._positions[device_id] = position
+            self._absent.pop(device_id, None)
+
+    def get(self, device_id: str) -> IndexedPosition | None:
+        return self._positions.get(device_id)
+
+    def missing(self, device_ids: Iterable[str]) -> list[str]:
+        """Device ids that are neither indexed nor recently known to have no
+        stored location."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                device_id
+                for device_id in device_ids
+                if device_id not in self._positions and self._absent.get(device_id, 0.0) <= now
+            ]
+
+    def mark_absent(self, device_ids: Iterable[str]) -> None:
+        expires_at = time.monotonic() + self.absent_ttl_seconds
+        with self._lock:
+            for device_id in device_ids:
+                if device_id not in self._positions:
+                    self._absent[device_id] = expires_at
+
+    def remove(self, device_id: str) -> None:
+        with self._lock:
+            self._absent.pop(device_id, None)
+            previous = self._positions.pop(device_id, None)
+            if previous is not None:
+                self._unbucket(device_id, previous.geohash, "")
+
+    def within(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_meters: float,
+        device_ids: set[str] | None = None,
+    ) -> list[tuple[IndexedPosition, float]]:
+        """Indexed positions within ``radius_meters`` of the point, nearest
+        first, optionally restricted to ``device_ids``."""
+        cells = None
+        for precision in range(self.precision, 0, -1):
+            cells = _covering_cells(latitude, longitude, radius_meters, precision)
+            if cells is not None:
+                break
+
+        with self._lock:
+            if cells is None:
+                cell_candidates = len(self._positions)
+            else:
+                buckets = [self._cells[cell] for cell in cells if cell in self._cells]
+                cell_candidates = sum(len(bucket) for bucket in buckets)
+
+            if device_ids is not None and len(device_ids) <= cell_candidates:
+                positions = [
+                    self._positions[device_id] for device_id in device_ids if device_id in self._positions
+                ]
+            elif cells is None:
+                positions = list(self._positions.values())
+            else:
+                candidates = set().union(*buckets)
+                if device_ids is not None:
+                    candidates &= device_ids
+                positions = [self._positions[candidate] for candidate in candidates]
+
+        matches = []
+        for position in positions:
+            distance = haversine_meters(latitude, longitude, position.latitude, position.longitude)
+            if distance <= radius_meters:
+                matches.append((position, distance))
+        matches.sort(key=lambda match: match[1])
+        return matches
+
+    def _bucket(self, device_id: str, geohash: str, keep: str) -> None:
+        for length in range(1, len(geohash) + 1):
+            prefix = geohash[:length]
+            if keep[:length] == prefix:
+                continue
+            self._cells.setdefault(prefix, set()).add(device_id)
+
+    def _unbucket(self, device_id: str, geohash: str, keep: str) -> None:
+        for length in range(1, len(geohash) + 1):
+            prefix = geohash[:length]
+            if keep[:length] == prefix:
+                continue
+            bucket = self._cells.get(prefix)
+            if bucket is None:
+                continue
+            bucket.discard(device_id)
+            if not bucket:
+                del self._cells[prefix]
+
+
+index = GeoIndex(precision=int(os.getenv("GEOINDEX_PRECISION", "7")))
@@ -1,11 +1,11 @@
 import logging
-from fastapi import Depends, FastAPI, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import Depends, FastAPI, HTTPException, Query
+from sqlalchemy.exc import SQLAlchemyError
 
 from dotenv import load_dotenv
 
-from . import apns, crud, models, schemas
-from .db import Base, engine, get_db
+from . import apns, codec, crud, erasure, models, schemas, sweeper
+from .db import Base, ShardSessions, engines, get_db
 
 
 load_dotenv()
@@ -16,7 +16,17 @@ logger = logging.getLogger("seguridad.api")
 
 @app.on_event("startup")
 def on_startup():
-    Base.metadata.create_all(bind=engine)
+    for shard_engine in engines:
+        Base.metadata.create_all(bind=shard_engine)
+    sweeper.start()
+    erasure.resume_unfinished()
+    erasure.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    sweeper.stop()
+    erasure.stop()
 
 
 @app.get("/health")
@@ -25,76 +35,173 @@ def health():
 
 
 @app.post("/devices/register")
-def register_device(payload: schemas.DeviceRegisterRequest, db: Session = Depends(get_db)):
+def register_device(payload: schemas.DeviceRegisterRequest, shards: ShardSessions = Depends(get_db)):
+    db = shards.for_device(payload.device_id)
     device = crud.get_or_create_device(db, payload.device_id, payload.platform)
     return {"deviceId": device.device_id}
 
 
+@app.delete("/devices/{device_id}", status_code=202, response_model=schemas.ErasureJobResponse)
+def erase_device(device_id: str, shards: ShardSessions = Depends(get_db)):
+    job = crud.create_erasure_job(shards, device_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown device")
+    if job.status == "pending":
+        erasure.enqueue(device_id, job.id)
+    return _erasure_job_response(job)
+
+
+@app.get("/devices/{device_id}/erasure", response_model=schemas.ErasureJobResponse)
+def erasure_status(device_id: str, shards: ShardSessions = Depends(get_db)):
+    job = crud.get_erasure_job(shards, device_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No erasure job")
+    return _erasure_job_response(job)
+
+
+def _erasure_job_response(job: models.ErasureJob) -> schemas.ErasureJobResponse:
+    return schemas.ErasureJobResponse(
+        deviceId=job.device_id,
+        status=job.status,
+        stage=job.stage,
+        deletedRows=job.deleted_rows,
+        error=job.error,
+        createdAt=job.created_at,
+        finishedAt=job.finished_at,
+    )
+
+
 @app.post("/device-tokens")
-def register_device_token(payload: schemas.DeviceTokenRequest, db: Session = Depends(get_db)):
-    crud.upsert_device_token(db, payload)
+def register_device_token(payload: schemas.DeviceTokenRequest, shards: ShardSessions = Depends(get_db)):
+    crud.upsert_device_token(shards, payload)
     return {"status": "ok"}
 
 
 @app.post("/safezones")
-def upsert_safezone(payload: schemas.SafeZoneRequest, db: Session = Depends(get_db)):
-    crud.upsert_safezone(db, payload)
+def upsert_safezone(payload: schemas.SafeZoneRequest, shards: ShardSessions = Depends(get_db)):
+    crud.upsert_safezone(shards, payload)
     return {"status": "ok"}
 
 
-@app.post("/locations")
-def create_location(payload: schemas.LocationUpdateRequest, db: Session = Depends(get_db)):
-    crud.create_location(db, payload)
+_PACKED_BODY = {
+    "schema": {
+        "type": "string",
+        "format": "binary",
+        "description": (
+            "Little-endian uint16 device id length, UTF-8 device id, then 28-byte points "
+            "of float64 latitude, float64 longitude, float32 accuracy and float64 Unix seconds."
+        ),
+    }
+}
+_LOCATION_BODY = {"schema": schemas.LocationUpdateRequest.model_json_schema(by_alias=True)}
+_LOCATION_BATCH_BODY = {
+    "schema": {
+        "type": "object",
+        "required": ["deviceId", "points"],
+        "properties": {
+            "deviceId": {"type": "string"},
+            "points": {
+                "type": "array",
+                "items": {
+                    "type": "array",
+                    "description": (
+                        "[latitude, longitude, accuracy, timestamp]; timestamp in Unix seconds or ISO 8601"
+                    ),
+                    "minItems": 4,
+                    "maxItems": 4,
+                    "prefixItems": [
+                        {"type": "number", "minimum": -90, "maximum": 90},
+                        {"type": "number", "minimum": -180, "maximum": 180},
+                        {"type": "number", "minimum": 0},
+                        {"anyOf": [{"type": "number"}, {"type": "string", "format": "date-time"}]},
+                    ],
+                },
+            },
+        },
+    }
+}
+
+
+def _location_request_body(document_body: dict) -> dict:
+    content = {codec.JSON_CONTENT_TYPE: document_body}
+    content.update({content_type: document_body for content_type in codec.MSGPACK_CONTENT_TYPES})
+    content[codec.PACKED_CONTENT_TYPE] = _PACKED_BODY
+    return {"requestBody": {"required": True, "content": content}}
+
+
+@app.post("/locations", openapi_extra=_location_request_body(_LOCATION_BODY))
+def create_location(
+    payload: schemas.LocationUpdateRequest = Depends(codec.location_update),
+    shards: ShardSessions = Depends(get_db),
+):
+    crud.create_location(shards, payload)
     return {"status": "ok"}
 
 
+@app.post("/locations/batch", openapi_extra=_location_request_body(_LOCATION_BATCH_BODY))
+def create_location_batch(
+    batch: schemas.LocationBatch = Depends(codec.location_batch),
+    shards: ShardSessions = Depends(get_db),
+):
+    accepted = crud.create_locations(shards, batch)
+    return {"status": "ok", "accepted": accepted}
+
+
 @app.post("/alerts")
-def create_alert(payload: schemas.AlertEventRequest, db: Session = Depends(get_db)):
-    crud.create_alert(db, payload)
+def create_alert(payload: schemas.AlertEventRequest, shards: ShardSessions = Depends(get_db)):
+    crud.create_alert(shards, payload)
     try:
-        apns.send_alert_push(db, payload.device_id, payload.type)
+        apns.send_alert_push(shards, payload.device_id, payload.type)
     except Exception as exc:
         logger.warning("APNs push failed: %s", exc)
     return {"status": "ok"}
 
 
 @app.post("/contacts")
-def upsert_contact(payload: schemas.ContactRequest, db: Session = Depends(get_db)):
-    crud.upsert_contact(db, payload)
+def upsert_contact(payload: schemas.ContactRequest, shards: ShardSessions = Depends(get_db)):
+    crud.upsert_contact(shards, payload)
     return {"status": "ok"}
 
 
 @app.post("/subscriptions")
-def create_subscription(payload: schemas.SubscriptionRequest, db: Session = Depends(get_db)):
-    crud.create_subscription(db, payload)
+def create_subscription(payload: schemas.SubscriptionRequest, shards: ShardSessions = Depends(get_db)):
+    try:
+        crud.create_subscription(shards, payload)
+    except SQLAlchemyError as exc:
+        logger.warning("Subscription write failed: %s", exc)
+        raise HTTPException(status_code=503, detail="Subscription not stored; retry")
     return {"status": "ok"}
 
 
 @app.post("/invites", response_model=schemas.InvitationResponse)
-def create_invitation(payload: schemas.InvitationRequest, db: Session = Depends(get_db)):
-    invitation = crud.create_or_rotate_invitation(db, payload)
+def create_invitation(payload: schemas.InvitationRequest, shards: ShardSessions = Depends(get_db)):
+    invitation = crud.create_or_rotate_invitation(shards, payload)
     return schemas.InvitationResponse(code=invitation.code, expiresAt=invitation.expires_at)
 
 
 @app.get("/invites/{device_id}", response_model=schemas.InvitationResponse)
-def get_invitation(device_id: str, db: Session = Depends(get_db)):
-    invitation = crud.get_invitation_by_owner(db, device_id)
+def get_invitation(device_id: str, shards: ShardSessions = Depends(get_db)):
+    invitation = crud.get_invitation_by_owner(shards, device_id)
     if invitation is None:
         raise HTTPException(status_code=404, detail="No invitation")
     return schemas.InvitationResponse(code=invitation.code, expiresAt=invitation.expires_at)
 
 
 @app.post("/subscriptions/confirm")
-def confirm_subscription(payload: schemas.SubscriptionConfirmRequest, db: Session = Depends(get_db)):
-    owner_device_id = crud.confirm_subscription_with_code(db, payload)
+def confirm_subscription(payload: schemas.SubscriptionConfirmRequest, shards: ShardSessions = Depends(get_db)):
+    try:
+        owner_device_id = crud.confirm_subscription_with_code(shards, payload)
+    except SQLAlchemyError as exc:
+        logger.warning("Subscription write failed: %s", exc)
+        raise HTTPException(status_code=503, detail="Subscription not stored; retry")
     if owner_device_id is None:
         raise HTTPException(status_code=400, detail="Invalid or expired code")
     return schemas.SubscriptionConfirmResponse(ownerDeviceId=owner_device_id)
 
 
 @app.get("/locations/latest/{device_id}", response_model=schemas.LocationResponse)
-def latest_location(device_id: str, db: Session = Depends(get_db)):
-    event = crud.get_latest_location(db, device_id)
+def latest_location(device_id: str, shards: ShardSessions = Depends(get_db)):
+    event = crud.get_latest_location(shards, device_id)
     if event is None:
         raise HTTPException(status_code=404, detail="No location data")
     return schemas.LocationResponse(
@@ -106,8 +213,8 @@ def latest_location(device_id: str, db: Session = Depends(get_db)):
 
 
 @app.get("/locations/history/{device_id}", response_model=list[schemas.LocationResponse])
-def location_history(device_id: str, limit: int = 100, db: Session = Depends(get_db)):
-    events = crud.get_location_history(db, device_id, limit=limit)
+def location_history(device_id: str, limit: int = 100, shards: ShardSessions = Depends(get_db)):
+    events = crud.get_location_history(shards, device_id, limit=limit)
     return [
         schemas.LocationResponse(
             latitude=event.latitude,
@@ -119,8 +226,37 @@ def location_history(device_id: str, limit: int = 100, db: Session = Depends(get
     ]
 
 
+@app.get("/locations/nearby/{device_id}", response_model=list[schemas.NearbyDeviceResponse])
+def nearby_devices(
+    device_id: str,
+    radius: float = 1000.0,
+    latitude: float | None = Query(default=None, ge=-90, le=90),
+    longitude: float | None = Query(default=None, ge=-180, le=180),
+    shards: ShardSessions = Depends(get_db),
+):
+    if radius <= 0:
+        raise HTTPException(status_code=400, detail="Radius must be positive")
+    if (latitude is None) != (longitude is None):
+        raise HTTPException(status_code=400, detail="Latitude and longitude go together")
+    matches = crud.get_nearby_followed(shards, device_id, radius, latitude=latitude, longitude=longitude)
+    if matches is None:
+        raise HTTPException(status_code=404, detail="No location data")
+    return [
+        schemas.NearbyDeviceResponse(
+            deviceId=position.device_id,
+            latitude=position.latitude,
+            longitude=position.longitude,
+            accuracy=position.accuracy,
+            timestamp=position.timestamp,
+            distanceMeters=distance,
+        )
+        for position, distance in matches
+    ]
+
+
 @app.get("/safezones/{device_id}")
-def list_safezones(device_id: str, db: Session = Depends(get_db)):
+def list_safezones(device_id: str, shards: ShardSessions = Depends(get_db)):
+    db = shards.for_device(device_id)
     device = crud.get_device_by_device_id(db, device_id)
     if device is None:
         return []
@@ -143,7 +279,8 @@ def list_safezones(device_id: str, db: Session = Depends(get_db)):
 
 
 @app.get("/contacts/{device_id}")
-def list_contacts(device_id: str, db: Session = Depends(get_db)):
+def list_contacts(device_id: str, shards: ShardSessions = Depends(get_db)):
+    db = shards.for_device(device_id)
     device = crud.get_device_by_device_id(db, device_id)
     if device is None:
         return []
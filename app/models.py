@@ -23,31 +23,33 @@ class Device(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     last_seen_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
-    safezones = relationship("SafeZone", back_populates="device", cascade="all, delete-orphan")
-    locations = relationship("LocationEvent", back_populates="device", cascade="all, delete-orphan")
-    alerts = relationship("AlertEvent", back_populates="device", cascade="all, delete-orphan")
-    contacts = relationship("Contact", back_populates="device", cascade="all, delete-orphan")
-    tokens = relationship("DeviceToken", back_populates="device", cascade="all, delete-orphan")
+    safezones = relationship("SafeZone", back_populates="device", cascade="all, delete-orphan", passive_deletes=True)
+    locations = relationship("LocationEvent", back_populates="device", cascade="all, delete-orphan", passive_deletes=True)
+    alerts = relationship("AlertEvent", back_populates="device", cascade="all, delete-orphan", passive_deletes=True)
+    contacts = relationship("Contact", back_populates="device", cascade="all, delete-orphan", passive_deletes=True)
+    tokens = relationship("DeviceToken", back_populates="device", cascade="all, delete-orphan", passive_deletes=True)
     subscriptions_owned = relationship(
         "Subscription",
         foreign_keys="Subscription.owner_device_id",
         back_populates="owner_device",
         cascade="all, delete-orphan",
+        passive_deletes=True,
     )
     subscriptions_subscribed = relationship(
         "Subscription",
         foreign_keys="Subscription.subscriber_device_id",
         back_populates="subscriber_device",
         cascade="all, delete-orphan",
+        passive_deletes=True,
     )
-    invitations = relationship("Invitation", back_populates="owner_device", cascade="all, delete-orphan")
+    invitations = relationship("Invitation", back_populates="owner_device", cascade="all, delete-orphan", passive_deletes=True)
 
 
 class SafeZone(Base):
     __tablename__ = "safezones"
 
     id = Column(Integer, primary_key=True)
-    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False)
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
     name = Column(String, nullable=False)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
@@ -62,7 +64,7 @@ class LocationEvent(Base):
     __tablename__ = "location_events"
 
     id = Column(Integer, primary_key=True)
-    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False)
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     accuracy = Column(Float, nullable=False)
@@ -76,7 +78,7 @@ class AlertEvent(Base):
     __tablename__ = "alert_events"
 
     id = Column(Integer, primary_key=True)
-    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False)
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
     type = Column(String, nullable=False)
     timestamp = Column(DateTime(timezone=True), nullable=False)
     latitude = Column(Float)
@@ -90,7 +92,7 @@ class Contact(Base):
     __tablename__ = "contacts"
 
     id = Column(Integer, primary_key=True)
-    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False)
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
     name = Column(String, nullable=False)
     phone = Column(String, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -102,7 +104,7 @@ class DeviceToken(Base):
     __tablename__ = "device_tokens"
 
     id = Column(Integer, primary_key=True)
-    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False)
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
     token = Column(String, unique=True, nullable=False)
     environment = Column(String, nullable=False, default="sandbox")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -115,8 +117,8 @@ class Subscription(Base):
     __tablename__ = "subscriptions"
 
     id = Column(Integer, primary_key=True)
-    owner_device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False)
-    subscriber_device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False)
+    owner_device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
+    subscriber_device_id = Column(Integer, ForeignKey("devices.id", ondelete="CASCADE"), nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     owner_device = relationship(
@@ -145,3 +147,16 @@ class Invitation(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     owner_device = relationship("Device", back_populates="invitations")
+
+
+class ErasureJob(Base):
+    __tablename__ = "erasure_jobs"
+
+    id = Column(Integer, primary_key=True)
+    device_id = Column(String, index=True, nullable=False)
+    status = Column(String, nullable=False, default="pending")
+    stage = Column(String)
+    deleted_rows = Column(Integer, nullable=False, default=0)
+    error = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True))
@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import NamedTuple
 from pydantic import BaseModel, ConfigDict, Field
 
 
@@ -34,6 +35,18 @@ class LocationUpdateRequest(BaseSchema):
     timestamp: datetime
 
 
+class LocationPoint(NamedTuple):
+    latitude: float
+    longitude: float
+    accuracy: float
+    timestamp: datetime
+
+
+class LocationBatch(NamedTuple):
+    device_id: str
+    points: list[LocationPoint]
+
+
 class AlertEventRequest(BaseSchema):
     device_id: str = Field(alias="deviceId")
     type: str
@@ -71,6 +84,25 @@ class SubscriptionConfirmResponse(BaseSchema):
     owner_device_id: str = Field(alias="ownerDeviceId")
 
 
+class NearbyDeviceResponse(BaseSchema):
+    device_id: str = Field(alias="deviceId")
+    latitude: float
+    longitude: float
+    accuracy: float
+    timestamp: datetime
+    distance_meters: float = Field(alias="distanceMeters")
+
+
+class ErasureJobResponse(BaseSchema):
+    device_id: str = Field(alias="deviceId")
+    status: str
+    stage: str | None = None
+    deleted_rows: int = Field(alias="deletedRows")
+    error: str | None = None
+    created_at: datetime | None = Field(default=None, alias="createdAt")
+    finished_at: datetime | None = Field(default=None, alias="finishedAt")
+
+
 class LocationResponse(BaseModel):
     latitude: float
     longitude: float
@@ -0,0 +1,62 @@
+import logging
+import os
+import threading
+
+from . import crud
+from .db import session_factories
+
+
+logger = logging.getLogger("seguridad.sweeper")
+
+SWEEP_INTERVAL_SECONDS = float(os.getenv("INVITE_SWEEP_INTERVAL_SECONDS", "300"))
+SWEEP_BATCH_SIZE = int(os.getenv("INVITE_SWEEP_BATCH_SIZE", "500"))
+if SWEEP_INTERVAL_SECONDS <= 0:
+    raise ValueError("INVITE_SWEEP_INTERVAL_SECONDS must be positive")
+if SWEEP_BATCH_SIZE <= 0:
+    raise ValueError("INVITE_SWEEP_BATCH_SIZE must be positive")
+
+_stop = threading.Event()
+_thread: threading.Thread | None = None
+
+
+def sweep_expired_invitations(batch_size: int = SWEEP_BATCH_SIZE) -> int:
+    """Delete expired invitations in batches so their codes can be reused."""
+    removed = 0
+    for session_factory in session_factories:
+        db = session_factory()
+        try:
+            while not _stop.is_set():
+                deleted = crud.delete_expired_invitations(db, batch_size)
+                removed += deleted
+                if deleted < batch_size:
+                    break
+        finally:
+            db.close()
+    return removed
+
+
+def start() -> None:
+    global _thread
+    if _thread is not None and _thread.is_alive():
+        return
+    _stop.clear()
+    _thread = threading.Thread(target=_run, name="invite-sweeper", daemon=True)
+    _thread.start()
+
+
+def stop() -> None:
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout=5)
+
+
+def _run() -> None:
+    while True:
+        try:
+            removed = sweep_expired_invitations()
+            if removed:
+                logger.info("Removed %d expired invitations", removed)
+        except Exception as exc:
+            logger.warning("Invitation sweep failed: %s", exc)
+        if _stop.wait(SWEEP_INTERVAL_SECONDS):
+            return